@@ -20,6 +20,9 @@ refine the FASTQ output if the filter option is used.
         elements are by read pair (so no suffix) or individual read (each read has 
         a suffix) and answer accordingly
         6. Path to the base output directory for writing out the FASTQ bins
+        7. Optional number of threads to decompress the FASTQ files with, split
+        between the two files (only used if rapidgzip or pugz is found in the 
+        PATH), and to write out the FASTQ bins with. Default 1.
 
     Output:
         1. Some statistics on the alignments like how many reads mapped to
@@ -31,16 +34,19 @@ refine the FASTQ output if the filter option is used.
         locus. 
 
     Usage:
-        fastq_reads_to_fastq_alleles.py --ab_read_map /path/to/analyze_bam.out --fastq1 /path/to/reads1.fastq.gz --fastq2 /path/to/reads2.fastq.gz --filter (yes|no) -reads_dir /path/to/read_dir
+        fastq_reads_to_fastq_alleles.py --ab_read_map /path/to/analyze_bam.out --fastq1 /path/to/reads1.fastq.gz --fastq2 /path/to/reads2.fastq.gz --filter (yes|no) -reads_dir /path/to/read_dir --cpus 4
 
     Author: 
         James Matsumura
 """
 
-import argparse,gzip,itertools
-from collections import defaultdict
+import argparse,contextlib,gzip,itertools,queue,resource,shutil,subprocess,sys,threading
+from collections import defaultdict,OrderedDict
 from shared_fxns import make_directory
 
+MAX_OPEN_WRITERS = 256 # most reads.fastq.gz files (and pigz processes) open at once
+FD_MARGIN = 32 # file descriptors left over for the FASTQ inputs and everything else
+
 def main():
 
     parser = argparse.ArgumentParser(description='Script to generate stats given output from analyze_bam.py and filter a set of paired-end FASTQ reads.')
@@ -50,8 +56,12 @@ def main():
     parser.add_argument('--filter', '-f', type=str, required=True, help='Either "yes" or "no" for removing discrepancies + multi-locus mapping reads.')
     parser.add_argument('--paired_suffixes', '-ps', type=str, required=True, help='Either "yes" or "no" for whether the reads are mapped to one another with suffixes like .1 and .2 and one wants to assess for concordancy. This is dependent on the aligner. Check the *read_map.tsv file and see if the first elements are by read pair (so no suffix) or individual read (each read has a suffix) and answer accordingly.')
     parser.add_argument('--reads_dir', '-rd', type=str, required=True, help='Path to where the output directory for the FASTQs to go.')
+    parser.add_argument('--cpus', '-c', type=int, required=False, default=1, help='Optional number of threads to decompress the FASTQ files with, split between the two files (only used if rapidgzip or pugz is found in the PATH), and to write out the FASTQ bins with. Default 1.')
     args = parser.parse_args()
 
+    if args.cpus < 1:
+        parser.error("--cpus must be at least 1")
+
     filter = args.filter
     output = args.reads_dir
 
@@ -60,33 +70,20 @@ def main():
     # Establish three dicts:
     # first two dicts consist of one for each mate
     # third dict is the IDs that need to be mapped (checking based on if the user wants to filter)
-    r1,r2,ids_to_keep = (defaultdict(list) for j in range(3)) # establish each mate dict as an empty list
-    
-    unique_refs = set() # make directories now for where all the reads will go
+    # Sets don't double up on references (possible if mapping to same locus from different samples)
+    r1,r2,ids_to_keep = (defaultdict(set) for j in range(3)) # establish each mate dict as an empty set
 
     if args.paired_suffixes == 'yes':
         # This first iteration only cares about grabbing all mates and their reference alignment info
         with open(args.ab_read_map,'r') as reads:
             for line in reads: 
                 
-                line = line.rstrip()
-                ele = line.split('\t')
-                
-                if ele[0][-1] == "1": # read mate 1
-                    for j in range(1,len(ele)):
-                        alignment = ele[j].split('|') # split the alignment data
-                        ref = alignment[2].split('.') # split the reference name
-                        ref_loc = ref[1] # grab just the base reference locus
-                        # don't double up on references (possible if mapping to same locus from different samples)
-                        if ref_loc not in r1[ele[0]]: 
-                            r1[ele[0]].append(ref_loc)
-                else: # read mate 2
-                    for j in range(1,len(ele)):
-                        alignment = ele[j].split('|')
-                        ref = alignment[2].split('.')
-                        ref_loc = ref[1]
-                        if ref_loc not in r2[ele[0]]:
-                            r2[ele[0]].append(ref_loc)
+                parts = line.rstrip().split('\t')
+                key = parts[0]
+                bucket = r1 if key.endswith('1') else r2 # read mate 1 or 2
+
+                # grab just the base reference locus from the reference name in the alignment data
+                bucket[key].update(token.split('|',3)[2].split('.',2)[1] for token in parts[1:])
 
         shared_id = "" # id in the format of ABC.123 for pairs ABC.123.1 + ABC.123.2
         checked_ids,ref_dirs = (set() for j in range(2)) # set to speed up processing of R2 if already covered by R1
@@ -104,24 +101,16 @@ def main():
                 
                 # If a single map value, know that both reads share the same locus
                 if not r1[read]: # if R1 didn't map, means R2 did
-                    ids_to_keep[shared_id].append(r2[mate_id][0])
+                    ids_to_keep[shared_id].update(r2[mate_id])
                 elif not r2[mate_id]: # same as above, if R2 didn't map, means R1 did
-                    ids_to_keep[shared_id].append(r1[read][0])
+                    ids_to_keep[shared_id].update(r1[read])
                 else: # else, they both mapped to the same locus and can use either value
-                    ids_to_keep[shared_id].append(r1[read][0])
-
-                unique_refs.add(ids_to_keep[shared_id][0]) # add the single locus
+                    ids_to_keep[shared_id].update(r1[read])
 
             else: # no filter needed, add all distinct loci found per read
 
-                for ref in r1[read]:
-                    ids_to_keep[shared_id].append(ref)
-                    unique_refs.add(ref) # add all loci
-
-                for ref in r2[mate_id]:
-                    if ref not in ids_to_keep[shared_id]: # make sure not to double up on loci across mates
-                        ids_to_keep[shared_id].append(ref)
-                        unique_refs.add(ref) # add all loci
+                # the set makes sure not to double up on loci across mates
+                ids_to_keep[shared_id].update(r1[read],r2[mate_id])
 
             checked_ids.add(shared_id) # identify these as looked at before going into r2 dict
 
@@ -134,15 +123,9 @@ def main():
                 count_val = verify_alignment(r1[mate_id],r2[read])
                 counts[count_val] += 1
 
-                # If we are here, the read was not found in R1. Thus, get loci strictly from R2.
-                if filter == "yes" and count_val == "single_map": 
-                    ids_to_keep[shared_id].append(r2[read][0])
-                    unique_refs.add(ids_to_keep[shared_id][0]) # add the single locus
-
-                else: # Again, was not found in R1 so we know all loci are from R2. 
-                    for ref in r2[read]:
-                        ids_to_keep[shared_id].append(ref)
-                        unique_refs.add(ref) # add the single locus
+                # If we are here, the read was not found in R1. Thus, get loci strictly 
+                # from R2 whether filtering or not.
+                ids_to_keep[shared_id].update(r2[read])
 
         # At this point, ids_to_keep now has a dictionary mapping all read IDs to loci that
         # they aligned to. This is all that's needed to build a set of directories that house
@@ -160,120 +143,302 @@ def main():
         with open(args.ab_read_map,'r') as reads:
             for line in reads: 
                 
-                line = line.rstrip()
-                ele = line.split('\t')
-                
-                for j in range(1,len(ele)):
-                    alignment = ele[j].split('|') # split the alignment data
-                    ref = alignment[2].split('.') # split the reference name
-                    ref_loc = ref[1] # grab just the base reference locus
-                    # don't double up on references (possible if mapping to same locus from different samples)
-                    if ref_loc not in ids_to_keep[ele[0]]: # just one dict here since gsnap doesn't capture read suffix
-                        ids_to_keep[ele[0]].append(ref_loc)
-                        unique_refs.add(ref_loc)
-
-    # Write out all the directories
+                parts = line.rstrip().split('\t')
+                key = parts[0]
+
+                # grab just the base reference locus from the reference name in the alignment data
+                # just one dict here since gsnap doesn't capture read suffix
+                ids_to_keep[key].update(token.split('|',3)[2].split('.',2)[1] for token in parts[1:])
+
+    # Write out all the directories for where all the reads will go
+    unique_refs = {ref for refs in ids_to_keep.values() for ref in refs}
     for ref in unique_refs:
         dir = "{0}/{1}".format(output,ref)
         make_directory(dir)
 
+    # Spread the loci across the writer threads so that each locus is only
+    # ever written by one of them.
+    targets = {ref:(j % args.cpus,ref) for j,ref in enumerate(unique_refs)}
+
+    # Freeze the IDs now that they're final, each pointing straight to the
+    # writer threads of the loci it belongs in. Most reads share the same few 
+    # sets of loci, so only build each tuple once. The FASTQ lines are read as
+    # bytes, so match against byte IDs.
+    writers_for,shared = {},{}
+    for id,refs in ids_to_keep.items():
+        refs = frozenset(refs)
+        if refs not in shared:
+            shared[refs] = tuple(targets[ref] for ref in refs)
+        writers_for[id.encode('ascii')] = shared[refs]
+    ids_to_keep,shared = None,None # done with these, free up some memory
+
     # Regardless of filtering based on alignment single/multiple/discrepancies or not, still
     # need to filter all the FASTQ reads to just those that aligned to a gene region.
-    filter_fastq(ids_to_keep,args.fastq1,args.fastq2,output)
+    # The open writers are split evenly between the writer threads. Only use 
+    # pigz when the thread with the most loci can keep all of its writers open,
+    # otherwise each writer closed to make room would mean starting another 
+    # pigz later.
+    max_open = max(1,writer_limit(len(unique_refs)) // args.cpus)
+    most_refs = -(-len(unique_refs) // args.cpus) # most loci given to one writer thread
+    filter_fastq(writers_for,args.fastq1,args.fastq2,output,args.cpus,max_open,most_refs <= max_open)
 
 
 # Function to compare where the two mates in a pair mapped to. Returns 
-# 'single_map' if both only map to a single locus, 'multi_map' if one
-# or both of the reads map to more than one locus, and 'discrep'  if 
-# the two mates do not map to the same locus. 
+# 'single_map' if both only map to a single locus (or just one mate maps
+# to a single locus), 'multi_map' if one or both of the reads map to more
+# than one locus, and 'discrepancy' if the two mates do not map to the
+# same locus. 
 # Arguments:
-# list1 = list of alignments from the first mate
-# list2 = list of alignments from the second mate
-def verify_alignment(list1,list2):
-
-    set1,set2 = (set() for j in range(2))
-    for ref in list1: # establish unique reference sets per read
-        set1.add(ref)
-    for ref in list2:
-        set2.add(ref)
-    
-    # only one locus, and the same one in both mates
-    if len(set1) == 1 and set1 == set2: 
-        return "single_map"
-    # this and the next account for where one read maps and the other doesn't
-    elif (len(set1) == 1 and set2 is None): 
-        return "single_map"
-    elif (len(set2) == 1 and set1 is None):
-        return "single_map"
+# set1 = set of loci aligned to by the first mate
+# set2 = set of loci aligned to by the second mate
+def verify_alignment(set1,set2):
+
     # some reads are mapping to more than one locus
-    elif ((len(set1) > 1) or (len(set2) > 1)): 
-        return "multi_map" 
-    # simmply not sharing the same loci, discrepancy!
-    elif set1 != set2: 
+    if len(set1) > 1 or len(set2) > 1:
+        return "multi_map"
+    # only one locus, and the same one in both mates or only one mate maps
+    elif set1 == set2 or not set1 or not set2:
+        return "single_map"
+    # simply not sharing the same loci, discrepancy!
+    else:
         return "discrepancy"
 
 # Function to parse through a FASTQ file and generate new ones that only consist
-# of IDs, per locus, found to be valid by the alignment and this script.
+# of IDs, per locus, found to be valid by the alignment and this script. This
+# thread only reads and routes the records, the writing/compression is handed
+# off to writer threads so that it overlaps with the reading/decompression.
 # Arguments:
-# ids = set of IDs to be checked against while parsing the FASTQ file.
+# writers_for = dict of IDs to be checked against while parsing the FASTQ file to a
+# tuple of (writer thread, locus) for the loci they belong in. IDs are removed as 
+# they're found.
 # file1 = path to first paired fastq file
 # file2 = path to second paired fastq file
 # outdir = directory prefix for where the output will be written. 
-def filter_fastq(ids,file1,file2,outdir):
-
-    entry1,entry2 = ([] for j in range(2))
-    lineno = 0
-    seen = 0 # count the reads to potentially leave the files early if all found
-    total = len(ids)
-
-    # Iterate over each file simultaneously
-    with gzip.open(file1,'rt') as f1:
-        with gzip.open(file2,'rt') as f2:
-            for line1,line2 in zip(f1,f2):
-                entry1.append(line1)
-                entry2.append(line2)
-                lineno += 1
-
-                if lineno == 4: # got a FASTQ entry, check if it's relevant
+# threads = number of threads to decompress the FASTQ files with, split 
+# between the two, as well as the number of writer threads
+# max_open = most writers that each writer thread can have open at once
+# use_pigz = whether to compress with pigz, if it is in the PATH
+def filter_fastq(writers_for,file1,file2,outdir,threads,max_open,use_pigz):
+
+    if not writers_for: # no reads to keep, so no need to read the FASTQs
+        return
+
+    batch_size = 256 # records to hand off to a writer thread at a time
+
+    # Bounded queues so reading can't race too far ahead of the writing
+    queues = [queue.Queue(maxsize=64) for j in range(threads)]
+    pending = [[] for j in range(threads)]
+    errors = []
+    pigz = shutil.which('pigz') if use_pigz else None
+    sinks = [threading.Thread(target=sink,args=(q,errors,outdir,max_open,pigz)) for q in queues]
+    for t in sinks:
+        t.start()
+
+    # Both files are decompressed at the same time, so they share the threads
+    per_file = max(1,threads // 2)
+
+    try:
+        # Iterate over each file simultaneously
+        with open_fastq(file1,per_file) as f1:
+            with open_fastq(file2,per_file) as f2:
+                paired = zip(f1,f2)
+                while True:
+                    # Pull a full FASTQ entry (4 lines) from each mate at once
+                    chunk = list(itertools.islice(paired,4))
+                    if len(chunk) < 4:
+                        break
+                    (h1,s1,p1,q1),(h2,s2,p2,q2) = zip(*chunk)
+
                     # Note that these mates will both be included if just one is relevant,
                     # so can do all checks using just one of the mates.
-                    header = entry1[0]
-                    elements = header.strip().split(' ')
-                    id = elements[0][1:] # drop the '@'
-                    if id.endswith('.1'):
-                        id = id[:-2] # drop the mate distinction of '.1' or '.2'
-
-                    if id in ids: # if relevant, write to all necessary directories/files
-                        seen += 1
-
-                        # SPAdes, more specifically BWA, complains if the read
-                        # IDs are not exactly the same. Thus, trim the .1 and 
-                        # .2 suffixes from each of the header lines. Only certain
-                        # data have these suffixes so only act if necessary.
-                        if entry1[0].split(' ')[0].endswith('.1'):
-                            entry1[0] = entry1[0].replace('.1 ',' ')
-                            entry1[2] = entry1[2].replace('.1 ',' ')
-                            entry2[0] = entry2[0].replace('.2 ',' ')
-                            entry2[2] = entry2[2].replace('.2 ',' ')
-
-                        # Establish all loci mapped to, could be many if not filtering
-                        for ref in ids[id]:
-                            
-                            dir = "{0}/{1}".format(outdir,ref)
-                            out = dir + "/reads.fastq.gz"
-
-                            # add to whatever FASTQ file is already there
-                            with gzip.open(out,'ab') as o:
-                                for l in entry1:
-                                    o.write(l.encode())
-                                for l in entry2:
-                                    o.write(l.encode())
-
-                    entry1,entry2 = ([] for j in range(2)) # reset for next entry
-                    lineno = 0
-
-                if seen == total: # got them all, leave
-                    break
+                    first_tok = h1.split(b' ',1)[0].rstrip()
+                    had_suffix = first_tok.endswith(b'.1')
+                    # drop the '@' and the mate distinction of '.1' or '.2'
+                    id = first_tok[1:-2] if had_suffix else first_tok[1:]
+
+                    # Each pair only shows up once, so drop the ID as it's found to keep
+                    # the lookup small and know when every read has been written.
+                    targets = writers_for.pop(id,None)
+                    if targets is None:
+                        continue
+
+                    # SPAdes, more specifically BWA, complains if the read
+                    # IDs are not exactly the same. Thus, trim the .1 and 
+                    # .2 suffixes from each of the header lines. Only certain
+                    # data have these suffixes so only act if necessary.
+                    if had_suffix:
+                        h1 = h1.replace(b'.1 ',b' ')
+                        h2 = h2.replace(b'.2 ',b' ')
+                        # The '+' lines are usually bare, only trim them if
+                        # they repeat the header.
+                        if len(p1) > 2:
+                            p1 = p1.replace(b'.1 ',b' ')
+                            p2 = p2.replace(b'.2 ',b' ')
+
+                    # Write to all loci mapped to, could be many if not filtering
+                    record = b''.join((h1,s1,p1,q1,h2,s2,p2,q2))
+                    for j,ref in targets:
+                        pending[j].append((ref,record))
+                        if len(pending[j]) == batch_size:
+                            queues[j].put(pending[j])
+                            pending[j] = []
+
+                    if not writers_for: # got them all, leave
+                        break
+
+    finally:
+        # Send whatever is left and tell the writer threads to finish up
+        for j in range(threads):
+            if pending[j]:
+                queues[j].put(pending[j])
+            queues[j].put(None)
+        for t in sinks:
+            t.join()
+
+    if errors:
+        raise errors[0]
+
+# Function for a writer thread to write out batches of records from
+# filter_fastq(). Records in a batch for the same locus are joined into a
+# single write. Only max_open writers are kept open, the least recently used
+# one is closed to make room and reopened in append mode if more of its reads
+# show up. Stops once it gets None. If a write fails, keep emptying the queue
+# so the reader isn't left blocked and report the error back.
+# Arguments:
+# q = queue of lists of (locus,record) to write
+# errors = list to add any exception to
+# outdir = directory prefix for where the output will be written. 
+# max_open = most writers this thread can have open at once
+# pigz = path to pigz, or None to use Python's gzip
+def sink(q,errors,outdir,max_open,pigz):
+
+    writers = OrderedDict() # locus to (writer,proc), least recently used first
+    started = set() # loci that already have a reads.fastq.gz from this run
+
+    try:
+        while True:
+            batch = q.get()
+            if batch is None:
+                break
+            if errors:
+                continue
+            try:
+                records = defaultdict(list)
+                for ref,record in batch:
+                    records[ref].append(record)
+                for ref,r in records.items():
+                    if ref in writers:
+                        writers.move_to_end(ref)
+                    else:
+                        if len(writers) >= max_open:
+                            close_writer(*writers.popitem(last=False)[1])
+                        out = "{0}/{1}/reads.fastq.gz".format(outdir,ref)
+                        writers[ref] = open_writer(out,'ab' if ref in started else 'wb',pigz)
+                        started.add(ref)
+                    writers[ref][0].write(b''.join(r))
+            except (Exception,SystemExit) as e:
+                errors.append(e)
+    finally:
+        for w,proc in writers.values():
+            try:
+                close_writer(w,proc)
+            except (Exception,SystemExit) as e:
+                errors.append(e)
+
+# Function to open a fastq.gz file for reading in binary mode. Decompression is done in
+# parallel by piping from rapidgzip or pugz if either is in the PATH,
+# otherwise falls back to Python's gzip.
+# Arguments:
+# path = path to a fastq.gz file
+# threads = number of threads the decompressor can use
+@contextlib.contextmanager
+def open_fastq(path,threads):
+
+    decompressors = (
+        ('rapidgzip', ['-d','-c','-P',str(threads),path]),
+        ('pugz', ['-t',str(threads),path])
+    )
+
+    for name,opts in decompressors:
+        exe = shutil.which(name)
+        if exe is None:
+            continue
+
+        proc = subprocess.Popen([exe] + opts,stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            # Leaving early (all reads found) means the rest of the output
+            # is unwanted, so stop the decompressor instead of draining it.
+            stopped = False
+            if proc.stdout.read(1):
+                proc.terminate()
+                stopped = True
+            proc.stdout.close()
+            retval = proc.wait()
+            if not stopped and retval != 0:
+                sys.exit("{0} command returned exit code {1} on {2}".format(name,retval,path))
+        return
+
+    with gzip.open(path,'rb') as f:
+        yield f
+
+# Function to work out how many reads.fastq.gz writers can be open at once.
+# Keeping a writer open per locus avoids starting a new gzip member for every
+# read pair, but each one holds a file descriptor (and a pigz process), so 
+# they are capped at MAX_OPEN_WRITERS and by the limit on open files. The soft
+# limit is raised if that is both needed and allowed.
+# Argument:
+# nrefs = number of loci that will be written to
+def writer_limit(nrefs):
+
+    want = min(nrefs,MAX_OPEN_WRITERS) + FD_MARGIN
+    soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < want:
+        if hard != resource.RLIM_INFINITY:
+            want = min(want,hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE,(want,hard))
+            soft = want
+        except (ValueError,OSError):
+            pass
+
+    if soft == resource.RLIM_INFINITY:
+        return MAX_OPEN_WRITERS
+    return max(1,min(MAX_OPEN_WRITERS,soft - FD_MARGIN))
+
+# Function to open a reads.fastq.gz writer for a locus. Uses pigz when it is
+# given, otherwise falls back to Python's gzip. These are only intermediate
+# files for assembly, so favor speed over size with the fastest compression 
+# level and no timestamp in the header. Each pigz gets a single thread since
+# the writer threads already spread the compression across --cpus. Appending 
+# adds another gzip member, which is still read as one file.
+# Arguments:
+# out = path to the reads.fastq.gz file
+# mode = 'wb' to start the file or 'ab' to add to it
+# pigz = path to pigz, or None to use Python's gzip
+def open_writer(out,mode,pigz):
+
+    if pigz:
+        with open(out,mode) as o: # child keeps its own handle on the file
+            proc = subprocess.Popen([pigz,'-1','-n','-p','1','-c'],stdin=subprocess.PIPE,stdout=o)
+        return proc.stdin,proc
+
+    return gzip.GzipFile(out,mode,compresslevel=1,mtime=0),None
+
+# Function to flush and close a writer from open_writer(). Halts if the pigz
+# process did not finish cleanly.
+# Arguments:
+# writer = open reads.fastq.gz writer
+# proc = pigz process backing the writer, if any
+def close_writer(writer,proc):
+
+    writer.close()
+
+    if proc is not None:
+        retval = proc.wait()
+        if retval != 0:
+            sys.exit("pigz command returned exit code {0}".format(retval))
 
 
 if __name__ == '__main__':
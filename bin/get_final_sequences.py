@@ -31,9 +31,14 @@ of reference sequence that aligned with assembled sequence.
 
 import argparse,collections,sys,os
 from Bio import SeqIO
-from Bio.SeqRecord import SeqRecord
-from Bio.Seq import Seq
-from collections import defaultdict
+from collections import Counter,defaultdict,namedtuple
+from functools import lru_cache
+
+# Complement of each IUPAC nucleotide code, for reverse complementing
+COMPLEMENT = str.maketrans('ACGTMRWSYKVHDBNacgtmrwsykvhdbn','TGCAKYWSRMBDHVNtgcakywsrmbdhvn')
+
+# Best alignment found for an entity from ids_v_cov.tsv
+Hit = namedtuple('Hit','id file length cov ref_seq ref_len')
 
 def main():
 
@@ -48,67 +53,62 @@ def main():
     parser.add_argument('--min_align_len', '-minl', type=float, required=False, default=0.5, help='Optional minimum length ratio of an assembled sequence as cutoff for pulling a sequence or not. Default 0.5.')
     args = parser.parse_args()
 
-    best_id,cds_map = (defaultdict(list) for i in range(2)) 
-    cds_lengths = {} # count how many exons in a CDS from ea_map
-    seq_dict = SeqIO.to_dict(SeqIO.parse(args.original_fsa,"fasta"))
+    best_id = {} # entity to its best Hit
+    cds_map = defaultdict(list)
+    cds_lengths = Counter() # count how many exons in a CDS from ea_map
+    # Only index the reference FASTA, records are parsed when looked up
+    seq_dict = SeqIO.index(args.original_fsa,"fasta")
     min_len = args.min_align_len
 
+    ref_lens = {} # reference lengths, only look up each in seq_dict once
+
+    # Modify the path to where this file is found; needs some extra 
+    # handholding to work both with/without CWL
+    base_dir = args.align_path
+    split_point = os.path.basename(base_dir)
+
     with open(args.ivc,'r') as infile:
         for line in infile:
             line = line.rstrip()
             elements = line.split('\t')
 
-            entity = ""
-            if args.groupby != 'l':
-                entity = os.path.basename(elements[5]).split('.WITH')[0]
-                #Check ids_v_cov.tsv to find ref.geneID; test the following line
-                #ref_seq = entity
-            else:
-                entity = os.path.basename(elements[5]).split('.')[1]
-                ref_seq = os.path.basename(elements[5]).split('.WITH')[0]
-
-            # Modify the path to where this file is found; needs some extra 
-            # handholding to work both with/without CWL
-            base_dir = args.align_path
-            split_point = os.path.basename(base_dir)
-            tmp_path = elements[5].split(split_point)[1]
-            file_path = "{0}/{1}".format(base_dir,tmp_path)
-            unbuffered_ref_seq = seq_dict[ref_seq]
-            
-            # Sort the %ID into bins
+            # Sort the %ID into bins, skip early if below the cutoff
             id = 0.0
             if len(elements) == 6:
                 id = float(elements[0])
             else:
                 id = float(elements[6])
 
+            if int(id) < args.threshold:
+                continue
+
+            basename = os.path.basename(elements[5])
+            entity = ""
+            if args.groupby != 'l':
+                entity = basename.split('.WITH')[0]
+                #Check ids_v_cov.tsv to find ref.geneID; test the following line
+                #ref_seq = entity
+            else:
+                entity = basename.split('.')[1]
+                ref_seq = basename.split('.WITH')[0]
+
             # Check the length and cov index positions for cds, 
             # alleles/exons and other groupby methods
-            length = int(elements[2])
-            cov = float(elements[1])
             ref_len = int(elements[4])
-            
-            if ref_len < int(len(unbuffered_ref_seq)*min_len):
-                continue
 
-            if int(id) < args.threshold:
+            if ref_seq not in ref_lens:
+                ref_lens[ref_seq] = len(seq_dict[ref_seq])
+
+            if ref_len < int(ref_lens[ref_seq]*min_len):
                 continue
 
-            if entity in best_id:
-                if id > best_id[entity][0]:
-                    best_id[entity][0] = id
-                    best_id[entity][1] = file_path
-                    best_id[entity][2] = length
-                    best_id[entity][3] = cov
-                    best_id[entity][4] = ref_seq
-                    best_id[entity][5] = ref_len
-            else:
-                best_id[entity].append(id)
-                best_id[entity].append(file_path)
-                best_id[entity].append(length)
-                best_id[entity].append(cov)
-                best_id[entity].append(ref_seq)
-                best_id[entity].append(ref_len)
+            length = int(elements[2])
+            cov = float(elements[1])
+            tmp_path = elements[5].split(split_point)[1]
+            file_path = "{0}/{1}".format(base_dir,tmp_path)
+
+            if entity not in best_id or id > best_id[entity].id:
+                best_id[entity] = Hit(id,file_path,length,cov,ref_seq,ref_len)
 
     if args.groupby == 'cds':
         for k,v in best_id.items():
@@ -117,13 +117,8 @@ def main():
 
         with open(args.ea_map,'r') as infile:
             for line in infile:
-                elements = line.split('\t')
-                for x in range(1,len(elements)):
-                    parent = get_exon_parent(elements[x].split('|')[-1]).strip()
-                    if parent in cds_lengths:
-                        cds_lengths[parent] += 1
-                    else:
-                        cds_lengths[parent] = 1
+                elements = line.rstrip('\n').split('\t')
+                cds_lengths.update(get_exon_parent(e.rsplit('|',1)[-1]) for e in elements[1:])
 
         # sort the keys to output exons in order and make joining for CDS easy
         delete_us = set()
@@ -134,10 +129,10 @@ def main():
 
         # Check if this section fails by introduction of lengths and cov in cds_map values
             elif len(cds_map[k]) > 1: # only sort if multiple exons
-                if 'mrna' in cds_map[k][0][1]:
-                    cds_map[k].sort(key = lambda x: int(x[1].rsplit('exon',1)[1].split('.')[0]))   
+                if 'mrna' in cds_map[k][0].file:
+                    cds_map[k].sort(key = lambda x: int(x.file.rsplit('exon',1)[1].split('.')[0]))   
                 else:
-                    cds_map[k].sort(key = lambda x: int(x[1].split('-')[1].split('.')[0]))
+                    cds_map[k].sort(key = lambda x: int(x.file.split('-')[1].split('.')[0]))
 
         for incomplete in delete_us:
             del cds_map[incomplete]
@@ -147,42 +142,67 @@ def main():
     if args.groupby != 'cds': # treat individual loci/alleles/exons differently than CDS
         for k,v in best_id.items():
             new_id = "assembled_{0}".format(k)
-            ref_len = v[5]
-            seq = seq_dict[v[4]] 
-            ref_len_percent = round((ref_len/len(seq)*100), 2)
-            file = v[1].replace('trimmed_align.txt','b.fsa')
+            ref_len_percent = round((v.ref_len/ref_lens[v.ref_seq]*100), 2)
+            file = v.file.replace('trimmed_align.txt','b.fsa')
 
-            record = SeqIO.read(file, "fasta")
-            record.id = new_id
-            record.description = 'ID_to_ref={0} len={1} ref_len_percent={2}'.format(v[0],v[2],str(ref_len_percent))
-            record.name = ''
-            if '.r.trimmed' in v[1]:
-                tmp_seq = Seq(str(record.seq))
-                record.seq = tmp_seq.reverse_complement() 
+            tmp_seq = read_single_fasta(file)
+            if '.r.trimmed' in v.file:
+                tmp_seq = reverse_complement(tmp_seq)
 
-            final_sequences.append(record)
+            header = '{0} ID_to_ref={1} len={2} ref_len_percent={3}'.format(new_id,v.id,v.length,str(ref_len_percent))
+            final_sequences.append((header,tmp_seq))
 
     else:
         for k,v in cds_map.items():
             sequence = ''
             for exon in v:
-                file = exon[1].replace('trimmed_align.txt','b.fsa')
-                record = SeqIO.read(file, "fasta")
-                if '.r.trimmed' in exon[1]:
-                    tmp_seq = Seq(str(record.seq))
-                    sequence += str(tmp_seq.reverse_complement() )
+                file = exon.file.replace('trimmed_align.txt','b.fsa')
+                exon_seq = read_single_fasta(file)
+                if '.r.trimmed' in exon.file:
+                    sequence += reverse_complement(exon_seq)
 
                 else:
-                    sequence += str(record.seq)
+                    sequence += exon_seq
 
             # Add len and ref_len in record description
-            record = SeqRecord(Seq(sequence),id="cds_{0}".format(k),description='')
-           
-            final_sequences.append(record)
+            final_sequences.append(("cds_{0}".format(k),sequence))
 
-    SeqIO.write(final_sequences, args.outfile, 'fasta')
+    write_sequences(final_sequences,args.outfile)
             
+# Function to write out the final sequences as FASTA with 60 bases per line,
+# same as SeqIO.write but without its per-record formatting overhead.
+# Arguments:
+# records = list of (header,sequence) tuples to write
+# outfile = path to the FASTA file to write
+def write_sequences(records,outfile):
+    with open(outfile,'w') as out:
+        for header,seq in records:
+            out.write(">{0}\n".format(header))
+            out.writelines(seq[j:j+60] + "\n" for j in range(0, len(seq), 60))
+
+# Function to pull the sequence out of a FASTA file holding a single record.
+# These are small so skip the overhead of parsing them with SeqIO.
+# Argument:
+# file = path to a single record FASTA file
+def read_single_fasta(file):
+    with open(file,'r') as infile:
+        seq = infile.read().split('\n',1)[1]
+    return ''.join(seq.split())
+
+# Function to reverse complement a nucleotide sequence in a single pass,
+# without building a Seq object.
+# Argument:
+# seq = sequence string to reverse complement
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+# Function to get the parent CDS of an exon. The same exons come up many
+# times between the ids_v_cov.tsv and ea_map.tsv, so cache the results.
+# Argument:
+# exon = exon ID, may have trailing whitespace
+@lru_cache(maxsize=None)
 def get_exon_parent(exon):
+    exon = exon.strip()
     if '-' in exon or 'exon_' in exon:
         return exon.split('-')[0]
     else:
@@ -34,9 +34,20 @@ The columns are as follows (tab-separated):
         James Matsumura
 """
 
-import re,argparse,os,collections,tempfile
+import argparse,os,collections,tempfile
 import multiprocessing as mp
-from Bio import AlignIO
+import numpy as np
+
+# Numba is optional, without it the NumPy version of the exact alignment is used.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+GAP = ord('-')
+ALIGN_SUFFIX = '.trimmed_align.txt'
+BATCH_SIZE = 64 # loci per task sent to a worker process
+SETTINGS = None # arguments shared by every locus, set by init_worker()
 
 def main():
 
@@ -53,158 +64,72 @@ def main():
     # ensure that multiprocessing module doesn't use NFS
     tempfile.tempdir = '/tmp'
 
-    # Set up the multiprocessing manager, pool, and queue
-    manager = mp.Manager()
-    q = manager.Queue()
-    pool = mp.Pool(args.cpus + 1)
-    pool.apply_async(listener, (q,args.ivc_outfile))
-    jobs = []
-
-    # Need to iterate over the map generated from SPAdes step.
-    with open(args.assmb_map,'r') as loc_map:
+    # The arguments that are the same for every locus are handed to each 
+    # worker process once when it starts rather than with every batch.
+    settings = (args.align_path,args.priority,args.best_only,args.assmb_type == "HGA")
+
+    # The workers hand back the lines for each batch and this process is the 
+    # sole writer to the output file. This way there is no concern with locks
+    # and what not.
+    with mp.Pool(args.cpus,initializer=init_worker,initargs=settings) as pool:
+        with open(args.ivc_outfile,'wb') as out:
+            for output in pool.imap_unordered(run_batch,read_loci(args.assmb_map)):
+                out.write(output)
+
+# Function to iterate over the map generated from SPAdes step. The loci are 
+# handed out in batches so that thousands of small loci are not each paying 
+# for their own trip to and from a worker process. The batches are yielded 
+# as the map is read rather than building a list of every locus first.
+# Argument:
+# assmb_map = path to *map.tsv output from format_for_assembly.py or assembly_verdict.py
+def read_loci(assmb_map):
+    batch = []
+    with open(assmb_map,'r') as loc_map:
         for line in loc_map:
-            line = line.rstrip()
-            ele = line.split('\t')
-            locus = ele[0]
-
-            algn_dir = "{0}/{1}".format(args.align_path,locus)
-
-            if args.assmb_type == "SPAdes":
-                jobs.append(pool.apply_async(spades_worker, (algn_dir,locus,args.priority,args.best_only,q)))
-            elif args.assmb_type == "HGA":
-                jobs.append(pool.apply_async(scaffold_worker, (algn_dir,locus,args.priority,args.best_only,q)))
-
-    # Get all the returns from the apply_async function.
-    for job in jobs:
-        job.get()
-    
-    q.put('stop') # should be no more messages
-    pool.close() #  Tell the queue it's done getting new jobs
-    pool.join() # Make sure these new jobs are all finished
-    manager.shutdown() # Clean up / close files + sockets
-
-# This is the worker that each CPU will process asynchronously
+            batch.append(line.rstrip().split('\t',1)[0])
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+# Function to store the arguments shared by every locus in a worker process.
 # Arguments:
-# algn_dir = the locus that SPAdes attempted to assemble
-# locus = particular locus being assessed right now
+# align_path = same as args.align_path
 # priority = if provided, same as args.priority
 # best_only = "yes" or "no" for whether or not to report just the best or all alignments
-# queue = queue used to send writes to the outfile
-def spades_worker(algn_dir,locus,priority,best_only,queue):
-    isos,scores,ids,files,cov,length,ref_len = ([] for i in range(7)) # reinitialize for every locus
-
-    # If the minimum threshold is set high enough, it is possible for
-    # no alignments to have been performed. Print to STDOUT in case
-    # this does happen. 
-    aligned = False
-    # Found the alignment directory for this locus, now iterate over 
-    # the final alignments and pull the best score.
-    for file in os.listdir(algn_dir):
-        a,b = ("" for i in range(2)) # store lengths of the trimmed alignments
-
-        if file.endswith(".trimmed_align.txt"):
-
-            # If we know which reference we want to assemble, skip all other files. 
-            if priority != "" and not file.startswith(priority):
-                continue
-
-            aligned = True 
-            
-            isolate = file.split('.')[0] # grab the reference group
-            full_path = "{0}/{1}".format(algn_dir,file)
-
-            # Extract the sequence lengths to establish a ratio of
-            # potential coverage. >1 means reference is longer than
-            # assembled seq and <1 means the assembled seq is longer.
-            alignment = AlignIO.read(full_path,'emboss')
-            for sequence in alignment:
-                if a == "":
-                    a = str(sequence.seq)
-                else:
-                    b = str(sequence.seq)
-                
-                a_align_seq = a
-
-                if a != "" and b!= "":
-                    ref_align_len = find_ref_len(a,b,a_align_seq)
-
-
-                if a != "" and b != "":
-                    a = a.replace('-','')
-                    b = b.replace('-','')
-
-            stats = parse_alignment(full_path)
-
-            # Seems getting max from a list is faster than dict
-            isos.append(isolate)
-            scores.append(float(stats['score']))
-            ids.append(stats['id'])
-            cov.append(len(a)/len(b))
-            length.append(len(b))
-            ref_len.append(ref_align_len)
-            files.append(full_path)
-
-    # If no trimmed_align.txt files found, no alignments were performed
-    # even though contigs were present.
-    if aligned == False:
-        #print("The locus {0} could assemble but none of the contigs passed the minimum threshold chosen when running global_alignment.py".format(locus))
-        return
-
-    if best_only == 'yes':
-        best = ids.index(max(ids))
-
-        # This block is not needed for the current set of test cases but likely
-        # will be needed in the future. 
-        # Make sure a tie goes to the prioritized isolate.
-        #if priority != "":
-        #    m = max(ids)
-        #    x = [i for i, j in enumerate(ids) if j == m]
-        #    if len(x) > 1: # only a concern in the case of a tie
-        #        for i in x:
-        #            if isos[i] == priority:
-        #                best = i
-
-        best_iso = isos[best]
-        best_id = ids[best]
-        best_cov = cov[best]
-        best_len = length[best]
-        best_ref_len = ref_len[best]
-        best_file = files[best]
-
-        queue.put("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(best_id,best_cov,best_len,best_iso,best_ref_len,best_file))
-    
-    elif best_only == 'no':
-        for x in range(0,len(files)):
-            queue.put("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(ids[x],cov[x],length[x],isos[x],ref_len[x],files[x]))
-
-    # This block is not needed for the current set of test cases but likely
-    # will be needed in the future. 
-    #if priority != "":
-        # If the best hit was not the prioritized isolate, then print to STDOUT
-        # what the best value was for the priority as well as the actual best.
-    #    if best_iso != priority:
-    #        prioritized_indexes = [i for i,j in enumerate(isos) if j == priority]
-    #        prioritized_ids = [ids[i] for i in prioritized_indexes]
-            # Make sure the prioritized isolate has an alignment. 
-    #        prioritized_best_id = 0
-    #        if len(prioritized_ids) > 0:
-    #            prioritized_best_id = max(prioritized_ids)
-    #        print("{0}\t{1}\t{2}\t{3}\t{4}\t{5:.2f}".format(locus,best_iso,best_id,priority,prioritized_best_id,best_id-prioritized_best_id))
+# is_hga = True if the assembly came from HGA+SB rather than SPAdes
+def init_worker(align_path,priority,best_only,is_hga):
+    global SETTINGS
+    SETTINGS = (align_path,priority,best_only,is_hga)
+
+# Function to call the worker on each locus of a batch, since imap_unordered 
+# only passes along a single argument. The lines come back already encoded so
+# the main process can write them straight to the output file.
+# Argument:
+# batch = list of loci to assess
+def run_batch(batch):
+    align_path,priority,best_only,is_hga = SETTINGS
+    lines = ''.join(worker(f"{align_path}/{locus}",locus,priority,best_only,is_hga) for locus in batch)
+    return lines.encode()
 
 # This is the worker that each CPU will process asynchronously
-# 
-# This differs from the SPAdes aligner in that it also calculates
-# "exact alignment" where it finds what would be the aligned 
-# identity if gaps were ignored. 
+#
+# For HGA only the scaffolds are assessed and it also calculates "exact 
+# alignment" where it finds what would be the aligned identity if gaps 
+# were ignored. The best alignment is then chosen by that instead of %ID.
 #
 # Arguments:
-# algn_dir = the locus that HGA+SB attempted to assemble
+# algn_dir = the locus that SPAdes or HGA+SB attempted to assemble
 # locus = particular locus being assessed right now
 # priority = if provided, same as args.priority
 # best_only = "yes" or "no" for whether or not to report just the best or all alignments
-# queue = queue used to send writes to the outfile
-def scaffold_worker(algn_dir,locus,priority,best_only,queue):
-    isos,scores,ids,files,cov,length,ref_len,nogap_id = ([] for i in range(8)) # reinitialize for every locus
+# is_hga = True if the assembly came from HGA+SB rather than SPAdes
+# Returns all the lines to write to the outfile for this locus as one string
+# so that each locus is a single message back to the main process.
+def worker(algn_dir,locus,priority,best_only,is_hga):
+    rows = [] # output for this locus
+    best,best_val = None,None # running best when best_only is "yes"
 
     # If the minimum threshold is set high enough, it is possible for
     # no alignments to have been performed. Print to STDOUT in case
@@ -212,10 +137,11 @@ def scaffold_worker(algn_dir,locus,priority,best_only,queue):
     aligned = False
     # Found the alignment directory for this locus, now iterate over 
     # the final alignments and pull the best score.
-    for file in os.listdir(algn_dir):
-        a,b = ("" for i in range(2)) # store lengths of the trimmed alignments
-
-        if 'Scaffold' in file and file.endswith(".trimmed_align.txt"):
+    with os.scandir(algn_dir) as entries:
+        for entry in entries:
+            file = entry.name
+            if not file.endswith(ALIGN_SUFFIX) or (is_hga and 'Scaffold' not in file):
+                continue
 
             # If we know which reference we want to assemble, skip all other files. 
             if priority != "" and not file.startswith(priority):
@@ -224,169 +150,144 @@ def scaffold_worker(algn_dir,locus,priority,best_only,queue):
             aligned = True 
             
             isolate = file.split('.')[0] # grab the reference group
-            full_path = "{0}/{1}".format(algn_dir,file)
+            full_path = entry.path
 
             # Make sure the file is actually populated and EMBOSS didn't fail
-            if os.stat(full_path).st_size == 0:
-                #print("{0} is empty.".format(full_path))
+            if entry.stat().st_size == 0:
                 continue
 
-
             # Extract the sequence lengths to establish a ratio of
             # potential coverage. >1 means reference is longer than
             # assembled seq and <1 means the assembled seq is longer.
-            alignment = AlignIO.read(full_path,'emboss')
-            for sequence in alignment:
-                if a == "":
-                    a = str(sequence.seq)
-                else:
-                    b = str(sequence.seq)
-               
-                a_align_seq = a
-
-                if a != "" and b!= "":
-                    ref_align_len = find_ref_len(a,b,a_align_seq)
-
-                if a != "" and b != "":
-                    # Check how many bases of A are covered by B with exact 
-                    # matches and output this percentage. Ignore gaps.
-                    nogap_id.append(calculate_exact_alignment(a,b)) 
-
-                    # Just get the length of the sequences to calculate coverage.
-                    # Note that the presence of spacers or extraneous repeats 
-                    # can have a significant impact on shifting the coverage 
-                    # ratio to find the assembly as much longer. 
-                    a = a.replace('-','')
-                    b = b.replace('-','')
-
-            stats = parse_alignment(full_path)
-
-            # Seems getting max from a list is faster than dict
-            isos.append(isolate)
-            scores.append(float(stats['score']))
-            ids.append(stats['id'])
-            cov.append(len(a)/len(b))
-            length.append(len(b))
-            ref_len.append(ref_align_len)
-            files.append(full_path)
+            # Note that the presence of spacers or extraneous repeats 
+            # can have a significant impact on shifting the coverage 
+            # ratio to find the assembly as much longer. 
+            a,b,id_pct = parse_needle(full_path)
+            la,lb = len(a),len(b)
+            ref_align_len = find_ref_len(a,b,la,lb)
+            alen = la - a.count('-')
+            blen = lb - b.count('-')
+
+            row = (id_pct,alen/blen,blen,isolate,ref_align_len,full_path)
+            val = id_pct
+
+            # Check how many bases of A are covered by B with exact 
+            # matches and output this percentage. Ignore gaps. For HGA
+            # we want to find the best ID regardless of GAPs (meaning 
+            # how many of the reference bases can be covered).
+            if is_hga:
+                nogap_id = calculate_exact_alignment(a,b)
+                row += (nogap_id,)
+                val = float(nogap_id)
+
+            # Only hold on to the best alignment seen so far rather than 
+            # every candidate, the first one found wins a tie.
+            if best_only == 'yes':
+                if best is None or val > best_val:
+                    best,best_val = row,val
+            elif best_only == 'no':
+                rows.append(row)
 
     # If no trimmed_align.txt files found, no alignments were performed
     # even though contigs were present.
     if aligned == False:
-        #print("The locus {0} could build a scaffold but failed to find an alignment.".format(locus))
-        return
-
-    if best_only == 'yes':
-        # We want to find the best ID regardless of GAPs (meaning how many of the
-        # reference bases can be covered).
-        best = nogap_id.index(max(nogap_id))
-        
-        # This block is not needed for the current set of test cases but likely
-        # will be needed in the future. 
-        # Make sure a tie goes to the prioritized isolate.
-        #if priority != "":
-        #    m = max(ids)
-        #    x = [i for i, j in enumerate(ids) if j == m]
-        #    if len(x) > 1: # only a concern in the case of a tie
-        #        for i in x:
-        #            if isos[i] == priority:
-        #                best = i
-
-        best_iso = isos[best]
-        best_id = ids[best]
-        best_cov = cov[best]
-        best_len = length[best]
-        best_ref_len = ref_len[best]
-        best_file = files[best]
-        best_nogap_id = nogap_id[best]
-
-        queue.put("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(best_id,best_cov,best_len,best_iso,best_ref_len,best_file,best_nogap_id))
-
-    elif best_only == 'no':
-        for x in range(0,len(files)):
-            queue.put("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(ids[x],cov[x],length[x],isos[x],ref_len[x],files[x],nogap_id[x]))
-
-    # This block is not needed for the current set of test cases but likely
-    # will be needed in the future. 
-    #if priority != "":
-        # If the best hit was not the prioritized isolate, then print to STDOUT
-        # what the best value was for the priority as well as the actual best.
-    #    if best_iso != priority:
-    #        prioritized_indexes = [i for i,j in enumerate(isos) if j == priority]
-    #        prioritized_ids = [ids[i] for i in prioritized_indexes]
-            # Make sure the prioritized isolate has an alignment. 
-    #        prioritized_best_id = 0
-    #        if len(prioritized_ids) > 0:
-    #            prioritized_best_id = max(prioritized_ids)
-    #        print("{0}\t{1}\t{2}\t{3}\t{4}\t{5:.2f}".format(locus,best_iso,best_id,priority,prioritized_best_id,best_id-prioritized_best_id))
-
-
-# This will act as the sole writer to the output file. This way there is no 
-# concern with locks and what not. This listens for messages and writes to
-# the final map file. 
-# Arguments:
-# queue = queue used to communicate what should be written out
-# out_file = location and name of the file to write out
-def listener(queue,out_file):
-
-    while 1:
-        msg = queue.get()
-        if msg == 'stop':
-            break
-        with open(out_file,'a') as out:
-            out.write(str(msg))
-            out.flush()
-
-# Function to parse over the output of EMBOSS's Needle program and extract the
-# score of the alignment.
+        #print("The locus {0} could not find an alignment that passed the minimum threshold chosen when running global_alignment.py".format(locus))
+        return ''
+
+    if best is not None:
+        rows.append(best)
+
+    return ''.join('\t'.join(map(str,row)) + '\n' for row in rows)
+
+# Function to parse over the output of EMBOSS's Needle program in a single
+# pass. Extracts the %ID of the alignment from the header along
+# with the two aligned sequences.
 # Argument:
 # infile = *.trimmed_align.txt file generated from a Needle alignment. 
-def parse_alignment(infile):
+def parse_needle(infile):
 
-    stats = {'score':0,'id':0}
+    id_pct = 0
+    seqs = ([],[]) # rows of the aligned sequences A and B
+    index = 0
 
+    # These alignments are small, so read the whole file at once and parse it
+    # from memory rather than line by line.
     with open(infile,'r') as alignment:
-        for line in alignment:
-            if line.startswith('# Score:'):
-                stats['score'] = re.search(r'#\sScore:\s(.*)$',line).group(1) 
-            elif line.startswith('# Identity:'):
-                stats['id'] = re.search(r'#\sIdentity:\s+\d+/\d+\s\(\s?(\d+\.\d+)%\)$',line).group(1)
-                stats['id'] = float(stats['id'])
-            elif line.startswith('a.trimmed'): # reached actual alignment, no need
-                break
+        lines = alignment.read().splitlines()
+
+    for line in lines:
+        if line.startswith('#'):
+            if line.startswith('# Identity:'): # e.g. "# Identity:  100/120 (83.3%)"
+                id_pct = float(line.split('(',1)[1].split('%',1)[0])
+            continue
+
+        # Sequence rows are the ID and start position in the first 21
+        # characters followed by the aligned sequence and end position.
+        # These alternate between A and B, anything else is markup.
+        id_start = line[:21].split()
+        seq_end = line[21:].split()
+        if len(id_start) == 2 and len(seq_end) == 2:
+            seqs[index].append(seq_end[0])
+            index ^= 1
 
-    return stats
+    return ''.join(seqs[0]),''.join(seqs[1]),id_pct
 
 # Function to check how many bases from the reference are mapping to the 
-# assembled sequence. 
+# assembled sequence. Compares the aligned sequences as byte arrays rather
+# than base by base.
 def calculate_exact_alignment(aseq,bseq):
 
-    total,perfect_match = (0 for i in range(2))
+    a = np.frombuffer(aseq.encode('ascii'),dtype=np.uint8)
+    b = np.frombuffer(bseq.encode('ascii'),dtype=np.uint8)
 
-    for a_base,b_base in zip(aseq,bseq):
-        # If it's not a gap for A, check if it aligns perfectly to B
-        if a_base != "-": # only care about what exists in the reference
-            if a_base == b_base: # if match, note it as such
-                perfect_match += 1
-                total += 1
-            else: # not a reference gap and not a match
+    if njit is not None:
+        perfect_match,total = count_exact_matches(a,b)
+    else:
+        # only care about what exists in the reference, so ignore gaps in A
+        in_ref = a != GAP
+        total = int(np.count_nonzero(in_ref))
+        perfect_match = int(np.count_nonzero((a == b) & in_ref))
+
+    return f"{perfect_match/total*100:.2f}"
+
+# Compiled version of the counting in calculate_exact_alignment() that gets 
+# both the number of reference bases and how many of them match in a single
+# pass over the two arrays rather than building masks for each.
+# Arguments:
+# a = uint8 array of the aligned reference sequence
+# b = uint8 array of the aligned assembled sequence
+if njit is not None:
+    @njit(cache=True)
+    def count_exact_matches(a,b):
+        perfect_match,total = 0,0
+        for i in range(a.size):
+            if a[i] != GAP:
                 total += 1
+                if a[i] == b[i]:
+                    perfect_match += 1
+        return perfect_match,total
+
 
-    return "{0:.2f}".format(perfect_match/total*100)
-
-
-# Finding the length of reference sequence in alignment
-def find_ref_len(a,b,a_align_seq):
-    if a[0] != "-" and b[0] == "-":
-        bstrip1 = b.lstrip('-')
-        ltrim = len(b) - len(bstrip1)
-        a_align_seq = a[ltrim:]
-    if a[-1] != "-" and b[-1] == "-":
-        bstrip2 = b.rstrip('-')
-        rtrim = (len(b) - len(bstrip2)) * -1
-        a_align_seq = a_align_seq[:rtrim]
-    a_align_seq = a_align_seq.replace('-', '')
-    ref_align_len = len(a_align_seq)
+# Finding the length of reference sequence in alignment, ignoring where the
+# reference overhangs either end of the assembled sequence.
+# Arguments:
+# a = aligned reference sequence
+# b = aligned assembled sequence
+# la = length of a
+# lb = length of b
+def find_ref_len(a,b,la,lb):
+
+    a = np.frombuffer(a.encode('ascii'),dtype=np.uint8)
+    b = np.frombuffer(b.encode('ascii'),dtype=np.uint8)
+    b_bases = np.flatnonzero(b != GAP)
+
+    left,right = 0,la
+    if a[0] != GAP and b[0] == GAP:
+        left = b_bases[0] if b_bases.size else lb
+    if a[-1] != GAP and b[-1] == GAP:
+        right = b_bases[-1] + 1 if b_bases.size else 0
+
+    ref_align_len = int(np.count_nonzero(a[left:right] != GAP))
 
     return ref_align_len
 